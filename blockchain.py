@@ -48,14 +48,98 @@ You'll probably need this when calculating a transaction id.
 import sys
 assert sys.version_info >= (3, 6)
 import hashlib
+import math
 import pdb
 import copy
 import json
+import struct
+import logging
+import warnings
+from collections.abc import Mapping, MutableMapping
 # pip3 install dill
 import dill as serializer
 
+logger = logging.getLogger(__name__)
+
+# All hashing goes through this callable.  CPython's hashlib is backed by OpenSSL, which picks the
+# SHA-NI (x86) or SHA2 (ARMv8) instructions at runtime when the CPU has them.
+_SHA256 = hashlib.sha256
+
+def _sha256Accelerated():
+    """ Return True if sha256 runs on hardware SHA instructions, False if it does not, and None if we can't tell """
+    if _SHA256.__name__ != 'openssl_sha256':
+        return False  # hashlib's builtin fallback is plain C, never hardware accelerated
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = set(f.read().split())
+    except OSError:
+        return None
+    return 'sha_ni' in flags or 'sha2' in flags
+
+if _sha256Accelerated() is False:
+    warnings.warn("sha256 is not hardware accelerated (no SHA-NI/OpenSSL), hashing will be slower")
+
+def _hash_range(nodes):
+    """ sha256 each adjacent (left, right) pair of an even length list of 32 byte nodes, returning the next merkle level """
+    # zip over one iterator pairs the nodes in place, without building stride slices or a list of pairs
+    it = iter(nodes)
+    return [_SHA256(a + b).digest() for a, b in zip(it, it)]
+
+def _merkle_root(nodes):
+    """ Reduce a list of (at least 2) 32 byte leaves to the 32 byte merkle root.
+        This is the whole compute bound part of the tree, kept free of any object access so it can be swapped
+        for a batched native kernel without touching HashableMerkleTree.
+    """
+    while len(nodes) > 1:
+        if len(nodes) % 2 == 1:
+            nodes.append(bytes(32))  # append 32 bytes of 0 if odd number of nodes
+        # Serial on purpose: every input is 64 bytes, and hashlib only releases the GIL for 2048+ byte inputs,
+        # so a thread pool can't hash a level in parallel and only adds overhead
+        nodes = _hash_range(nodes)
+    return nodes[0]
+
+_CHECKERS = {}  # number of inputs : generated constraint checker (see _constraint_checker)
+
+def _constraint_checker(n):
+    """ Return a function check(outputs, inputs) that runs the n constraint scripts of a transaction with n inputs.
+        Spending is only allowed if every constraint returns exactly True; if one throws, or returns anything else, it is not.
+        The n calls are unrolled into a single 'and' expression (which stops at the first refusal) inside one try block.
+        Functions are generated once per input count and shared by every transaction of that shape.
+    """
+    check = _CHECKERS.get(n)
+    if check is None:
+        calls = " and ".join("o[%d].constraint(i[%d].satisfier) is True" % (k, k) for k in range(n)) or "True"
+        src = "def check(o, i):\n    try:\n        return %s\n    except Exception:\n        return False\n" % calls
+        namespace = {}
+        exec(src, namespace)
+        check = _CHECKERS[n] = namespace['check']
+    return check
+
+def _mine(prefix, target, nonce):
+    """ Return the first nonce (counting up from the passed nonce) for which sha256(prefix || nonce) < target.
+        The header prefix is packed once by the caller, so the loop does no object access at all.
+    """
+    # The prefix is exactly one 64 byte sha256 block, so compress it once and resume from that midstate for every nonce
+    midstate = _SHA256(prefix)
+    pack = struct.Struct('>Q').pack
+    if target >= 1 << 256:
+        return nonce  # every hash is below this target
+    # Equal length big endian byte strings compare exactly like the integers they encode,
+    # so compare digests directly rather than converting each one to an int.  The comparison stops at the first differing byte.
+    # Targets may be floats (e.g. genesisTarget / 2); for an integer hash h, h < target exactly when h < ceil(target)
+    target_bytes = math.ceil(target).to_bytes(32, 'big')
+    while True:
+        h = midstate.copy()
+        h.update(pack(nonce))
+        if h.digest() < target_bytes:
+            return nonce
+        nonce += 1
+
 class Output:
     """ This models a transaction output """
+    # Outputs, inputs, transactions and blocks are created in large numbers and never get extra attributes
+    __slots__ = ('constraint', 'amount', '_blob')
+
     def __init__(self, constraint = None, amount = 0):
         """ constraint is a function that takes 1 argument which is a list of 
             objects and returns True if the output can be spent.  For example:
@@ -74,9 +158,20 @@ class Output:
         
         self.constraint = constraint or (lambda x: True)  # No constraint if none provided
         self.amount = amount
+        self._blob = None
+
+    def blob(self):
+        """ Return the serialized constraint script, used when hashing the transaction that holds this output.
+            The constraint never changes after construction, so it is only serialized once.
+        """
+        if self._blob is None:
+            self._blob = serializer.dumps(self.constraint)
+        return self._blob
 
 class Input:
     """ This models an input (what is being spent) to a blockchain transaction """
+    __slots__ = ('txHash', 'txIdx', 'satisfier')
+
     def __init__(self, txHash, txIdx, satisfier):
         """ This input references a prior output by txHash and txIdx.
             txHash is therefore the prior transaction hash
@@ -89,6 +184,8 @@ class Input:
 
 class Transaction:
     """ This is a blockchain transaction """
+    __slots__ = ('inputs', 'outputs', 'data', '_hash', '_hashBytes', '_in_keys')
+
     def __init__(self, inputs=None, outputs=None, data = None):
         """ Initialize a transaction from the provided parameters.
             inputs is a list of Input objects that refer to unspent outputs.
@@ -99,11 +196,59 @@ class Transaction:
         self.inputs = inputs
         self.outputs = outputs
         self.data = data
+        # inputs, outputs and data are never changed after construction, so the hash is cached (as bytes and as an int)
+        self._hash = None
+        self._hashBytes = None
+        # The UTXO keys this transaction spends, so validation doesn't re-read each Input's attributes
+        self._in_keys = [(input.txHash, input.txIdx) for input in inputs] if inputs else []
 
     def getHash(self):
         """Return this transaction's probabilistically unique identifier as a big-endian integer"""
-        serialized = serializer.dumps(self)
-        return int.from_bytes(hashlib.sha256(serialized).digest(), 'big')
+        if self._hash is None:
+            self._hash = int.from_bytes(self.getHashBytes(), 'big')
+        return self._hash
+
+    def getHashBytes(self):
+        """Return this transaction's sha256 digest (32 bytes).  getHash() is the same value as a big-endian integer"""
+        if self._hashBytes is None:
+            self._hashBytes = _SHA256(self.serialize()).digest()
+        return self._hashBytes
+
+    def serialize(self):
+        """ Canonical byte encoding of this transaction, used to calculate its hash.
+            Every variable length field is length prefixed so that distinct transactions can't encode to the same bytes.
+            Only the output constraint scripts go through dill, and Output.blob() does that once per Output.
+        """
+        buf = bytearray()
+        # A coinbase (inputs == None) must not hash the same as a tx with an empty input list
+        buf += struct.pack('>?Q', self.inputs is None, len(self.inputs or []))
+        for input in self.inputs or []:
+            satisfier = repr(input.satisfier).encode()
+            buf += int.to_bytes(input.txHash, 32, 'big')
+            buf += struct.pack('>IQ', input.txIdx, len(satisfier))
+            buf += satisfier
+        buf += struct.pack('>Q', len(self.outputs or []))
+        for output in self.outputs or []:
+            # amount is encoded by repr so float (or arbitrarily large) amounts hash too; 2 and 2.0 stay distinct
+            amount = repr(output.amount).encode()
+            blob = output.blob()
+            buf += struct.pack('>Q', len(amount))
+            buf += amount
+            buf += struct.pack('>Q', len(blob))
+            buf += blob
+        # data is tagged by type so that e.g. data=3 and data=b'\x00\x00\x00' can't collide; anything that isn't
+        # bytes-like or a str (ints, dicts, ...) is encoded by repr, the same way amounts are
+        if self.data is None:
+            tag, data = b'n', b''
+        elif isinstance(self.data, (bytes, bytearray, memoryview)):
+            tag, data = b'b', bytes(self.data)
+        elif isinstance(self.data, str):
+            tag, data = b's', self.data.encode()
+        else:
+            tag, data = b'r', repr(self.data).encode()
+        buf += struct.pack('>cQ', tag, len(data))
+        buf += data
+        return bytes(buf)
 
     def getInputs(self):
         """ return a list of all inputs that are being spent """
@@ -139,20 +284,19 @@ class Transaction:
         if not self.inputs:
             return True
         
-        for input in self.inputs:
-            if (input.txHash, input.txIdx) not in unspentOutputDict:
-                return False
-            
-        total_input = sum(unspentOutputDict[(input.txHash, input.txIdx)].amount for input in self.inputs)
+        # Look each spent output up once; the sum and the constraint checks below both reuse it
+        try:
+            spent = [unspentOutputDict[key] for key in self._in_keys]
+        except KeyError:
+            return False  # an input refers to an output that doesn't exist or was already spent
+
+        total_input = sum(output.amount for output in spent)
         total_output = sum(output.amount for output in self.outputs)
         print("unspentOutputDict", unspentOutputDict)
 
         if total_input < total_output:
             return False
-        for input in self.inputs:
-            if not unspentOutputDict[(input.txHash, input.txIdx)].constraint(input.satisfier):
-                return False
-        return True
+        return _constraint_checker(len(spent))(spent, self.inputs)
 
 
 class HashableMerkleTree:
@@ -173,22 +317,32 @@ class HashableMerkleTree:
 
     def __init__(self, hashableList = None):
         self.hashableList = hashableList or []
+        self._root = None
 
     def calcMerkleRoot(self):
         """ Calculate the merkle root of this tree."""
+        if self._root is None:
+            self._root = self._calcMerkleRoot()
+        return self._root
+
+    def cachedRoot(self):
+        """ Return the merkle root if it has been calculated since the tree last changed, otherwise None """
+        return self._root
+
+    def invalidate(self):
+        """ Forget the cached merkle root; call this after changing hashableList """
+        self._root = None
+
+    def _calcMerkleRoot(self):
         if not self.hashableList:
             return 0
         
         if len(self.hashableList) == 1:
             return self.hashableList[0].getHash()
         
-        nodes = [int.to_bytes(h.getHash(), 32, 'big') for h in self.hashableList]
-
-        while len(nodes) > 1:
-            if len(nodes) % 2 == 1:
-                nodes.append(bytes(32))  # append 32 bytes of 0 if odd number of nodes
-            nodes = [hashlib.sha256(nodes[i] + nodes[i + 1]).digest() for i in range(0, len(nodes), 2)]
-        return int.from_bytes(nodes[0], 'big')
+        # Use the raw digest when the object offers it rather than round-tripping through an int
+        nodes = [h.getHashBytes() if hasattr(h, 'getHashBytes') else int.to_bytes(h.getHash(), 32, 'big') for h in self.hashableList]
+        return int.from_bytes(_merkle_root(nodes), 'big')
 
 class BlockContents:
     """ The contents of the block (merkle tree of transactions)
@@ -210,6 +364,7 @@ class BlockContents:
 
         elif isinstance(d, HashableMerkleTree):
             self.data = d
+            self.data.invalidate()  # the tree's list may have been changed since its root was cached
         else:
             raise TypeError("Data must be a list of hashable objects or a HashableMerkleTree.")
 
@@ -219,17 +374,125 @@ class BlockContents:
     def calcMerkleRoot(self):
         return self.data.calcMerkleRoot()
 
+class UTXOView(MutableMapping):
+    """ A UTXO set layered on top of a parent UTXO set (a dict or another UTXOView).
+        Writes and deletes are recorded in this layer only, so the parent is never modified.  Each block's UTXO state
+        is a view over its parent's, so most views only cost the changes their block made.
+
+        A lookup that misses walks every layer, so once a view would be more than MAX_DEPTH layers deep its parent
+        is flattened into a new base dict.  That bounds lookups to MAX_DEPTH + 1 dict probes, at the price of one
+        full O(UTXO) copy held every MAX_DEPTH blocks.  The copy is made once per parent and shared by all of its
+        children (forks, re-validation), and a plain dict passed in by a caller is copied once as well.
+    """
+    MAX_DEPTH = 16
+
+    def __init__(self, parent):
+        if isinstance(parent, UTXOView):
+            if parent.depth >= self.MAX_DEPTH:
+                parent = parent._flatBase()
+                self.depth = 1
+            else:
+                self.depth = parent.depth + 1
+        else:
+            # Copy a caller's dict so changing it later can't change this set
+            parent = dict(parent)
+            self.depth = 1
+        self.parent = parent
+        self.adds = {}  # (txHash, offset) : Output added (or replaced) in this layer
+        self.dels = set()  # keys spent in this layer that may exist in the parent.  Never overlaps adds.
+        self._len = None  # computed by __len__ when needed, so writes never have to probe the parent
+        self._flat = None  # flattened copy shared as the base of children past MAX_DEPTH; never modified
+
+    def _lookup(self, key):
+        """ Return (True, Output) if key is unspent in this view, (False, None) otherwise """
+        # Walk the layers iteratively; there are at most MAX_DEPTH of them
+        view = self
+        while isinstance(view, UTXOView):
+            if key in view.adds:
+                return True, view.adds[key]
+            if key in view.dels:
+                return False, None
+            view = view.parent
+        if key in view:
+            return True, view[key]
+        return False, None
+
+    def __getitem__(self, key):
+        found, output = self._lookup(key)
+        if not found:
+            raise KeyError(key)
+        return output
+
+    def __contains__(self, key):
+        return self._lookup(key)[0]
+
+    def __setitem__(self, key, output):
+        self.dels.discard(key)
+        self.adds[key] = output
+        self._len = None
+        self._flat = None
+
+    def __delitem__(self, key):
+        if key in self.adds:
+            del self.adds[key]
+        elif key in self.dels or key not in self.parent:
+            raise KeyError(key)
+        self.dels.add(key)  # hides the parent's entry, if there is one
+        self._len = None
+        self._flat = None
+
+    def __len__(self):
+        if self._len is None:
+            # Keys of the parent that this layer spent or replaced don't count twice
+            hidden = sum(1 for key in self.dels if key in self.parent) + sum(1 for key in self.adds if key in self.parent)
+            self._len = len(self.parent) - hidden + len(self.adds)
+        return self._len
+
+    def __iter__(self):
+        return iter(self.flatten())
+
+    def __repr__(self):
+        return repr(self.flatten())
+
+    def _flatBase(self):
+        """ Return this view flattened, as a dict that is shared (read-only) by every child that needs it """
+        if self._flat is None:
+            self._flat = self.flatten()
+        return self._flat
+
+    def flatten(self):
+        """ Return this view as a plain dict.  This is O(size of the UTXO set) """
+        layers = []
+        view = self
+        while isinstance(view, UTXOView):
+            layers.append(view)
+            view = view.parent
+        result = dict(view)
+        for layer in reversed(layers):
+            for key in layer.dels:
+                result.pop(key, None)
+            result.update(layer.adds)
+        return result
+
 class Block:
     """ This class should represent a blockchain block.
         It should have the normal fields needed in a block and also an instance of "BlockContents"
         where we will store a merkle tree of transactions.
     """
+    __slots__ = ('contents', 'priorHash', 'target', 'nonce', '_merkle_tree', '_merkle_root', '_merkle_root_bytes')
+
     def __init__(self):
         # Hint, beyond the normal block header fields what extra data can you keep track of per block to make implementing other APIs easier?
         self.contents = BlockContents()
         self.priorHash = 0
         self.target = 0
         self.nonce = 0
+        # The merkle root as header bytes, so hashing the header doesn't go through BlockContents and the tree each time.
+        # _merkle_tree and _merkle_root are the tree and root it was computed from.  The cache is rebuilt if the tree is
+        # swapped via getContents().setData(), or if that tree's own cached root was reset (setData on a reused tree).
+        self._merkle_tree = None
+        self._merkle_root = None
+        self._merkle_root_bytes = None
         print("Init block", self)
 
     def getContents(self):
@@ -239,6 +502,7 @@ class Block:
     def setContents(self, data):
         """ set the contents of this block's merkle tree to the list of objects in the data parameter """
         self.contents.setData(data)
+        self._cacheMerkleRoot()
         print(f'''setContents {self.contents} at block {self}''')
 
     def setTarget(self, target):
@@ -251,8 +515,25 @@ class Block:
 
     def getHash(self):
         """ Calculate the hash of this block. Return as an integer """
-        serialized = serializer.dumps((self.priorHash, self.contents.calcMerkleRoot(), self.nonce))
-        return int.from_bytes(hashlib.sha256(serialized).digest(), 'big')
+        return int.from_bytes(self.getHashBytes(), 'big')
+
+    def getHashBytes(self):
+        """ Return the sha256 digest (32 bytes) of this block's header.  getHash() is the same value as a big-endian integer """
+        return _SHA256(self.headerPrefix() + struct.pack('>Q', self.nonce)).digest()
+
+    def headerPrefix(self):
+        """ The part of the block header that is fixed while mining: priorHash (32 bytes) || merkle root (32 bytes).
+            The full header appends the nonce as 8 big endian bytes.
+        """
+        tree = self.contents.data
+        if tree is not self._merkle_tree or tree.cachedRoot() != self._merkle_root:
+            self._cacheMerkleRoot()
+        return int.to_bytes(self.priorHash, 32, 'big') + self._merkle_root_bytes
+
+    def _cacheMerkleRoot(self):
+        self._merkle_tree = self.contents.data
+        self._merkle_root = self.contents.calcMerkleRoot()
+        self._merkle_root_bytes = self._merkle_root.to_bytes(32, 'big')
 
     def setPriorBlockHash(self, priorHash):
         """ Assign the parent block hash """
@@ -266,8 +547,7 @@ class Block:
     def mine(self, tgt):
         """Update the block header to the passed target (tgt) and then search for a nonce which produces a block who's hash is less than the passed target, "solving" the block"""
         self.target = tgt
-        while self.getHash() >= self.target:
-            self.nonce += 1
+        self.nonce = _mine(self.headerPrefix(), self.target, self.nonce)
 
     def validate(self, unspentOutputs, maxMint):
         """ Given a dictionary of unspent outputs, and the maximum amount of
@@ -278,14 +558,14 @@ class Block:
 
             Return a new UTXO set if the block is valid.
         """
-        assert isinstance(unspentOutputs, dict), "unspentOutputs must be a dictionary of tuples (hash, index) -> Output"
+        assert isinstance(unspentOutputs, Mapping), "unspentOutputs must be a dictionary of tuples (hash, index) -> Output"
 
         # Step 1: Check Proof of Work
         if self.getHash() >= self.target:
             return None  # Block does not meet the PoW requirement
 
         # Step 2: Initialize a new UTXO set to track changes in this block's transactions
-        new_utxo = unspentOutputs.copy()
+        new_utxo = UTXOView(unspentOutputs)
         transactions = self.contents.transactions
         # Step 3: Validate the coinbase transaction
         print("transactions", transactions)
@@ -324,12 +604,12 @@ class Block:
                 print("Updated new_utxo with transaction outputs:", new_utxo)
                 # Remove inputs from the UTXO set as they are now spent
                 print("tx.inputs", tx.inputs)
-                if tx.inputs:
-                    for input in tx.inputs:
-                        if (input.txHash, input.txIdx) not in new_utxo:
-                            print(f"Input {input.txHash, input.txIdx} not found in UTXO. Test failed.")
-                            return None
-                        del new_utxo[(input.txHash, input.txIdx)]
+                for key in tx._in_keys:
+                    try:
+                        del new_utxo[key]
+                    except KeyError:
+                        print(f"Input {key} not found in UTXO. Test failed.")
+                        return None
 
         # Step 6: Return the updated UTXO set if block is valid
         return new_utxo
@@ -354,14 +634,18 @@ class Blockchain(object):
         genesis.mine(genesisTarget)
         self.blocks[genesis.getHash()] = genesis
         self.cumulative_work[genesis.getHash()] = self.getWork(genesisTarget)
+        self.utxo_state[genesis.getHash()] = {} # genesis has no transactions
+        self.height = {genesis.getHash(): 0} # {block hash: height}
+        self.by_height = {0: [genesis]} # {height: [blocks at that height, in the order they were added]}
+        self._tip_hash = genesis.getHash() # hash of the most-work block, updated by extend
+        # {block hash: 64 bit filter of its ancestors}.  Bit (h & 63) is set for every ancestor hash h, so a clear bit
+        # proves a block is not an ancestor; a set bit has to be confirmed (see isAncestor)
+        self.ancestor_bits = {genesis.getHash(): 0}
         print("Init blockchain", self)
 
     def getTip(self):
         """ Return the block at the tip (end) of the blockchain fork that has the largest amount of work"""
-        max_work = max(self.cumulative_work, key=self.cumulative_work.get)
-        for block_hash in self.blocks:
-            if block_hash == max_work:
-                return self.blocks[block_hash]
+        return self.blocks[self._tip_hash]
 
     def getWork(self, target):
         """Get the "work" needed for this target.  Work is the ratio of the genesis target to the passed target"""
@@ -371,21 +655,24 @@ class Blockchain(object):
         """Return the cumulative work for the block identified by the passed hash.  Return None if the block is not in the blockchain"""
         return self.cumulative_work.get(blkHash, None)
 
+    def isAncestor(self, ancestorHash, blkHash):
+        """Return True if the block identified by ancestorHash is a (strict) ancestor of the block identified by blkHash"""
+        if blkHash not in self.ancestor_bits or ancestorHash not in self.height:
+            return False
+        if not (self.ancestor_bits[blkHash] >> (ancestorHash & 63)) & 1:
+            return False
+        # The filter can give false positives, so walk up to the ancestor's height and check
+        steps = self.height[blkHash] - self.height[ancestorHash]
+        if steps <= 0:
+            return False
+        curr = self.blocks[blkHash]
+        for _ in range(steps):
+            curr = self.blocks[curr.priorHash]
+        return curr.getHash() == ancestorHash
+
     def getBlocksAtHeight(self, height):
         """Return an array of all blocks in the blockchain at the passed height (including all forks)"""
-        
-        results = []
-        for block_hash in self.blocks:
-            curr_block = self.blocks[block_hash]
-            curr_height = 0
-            
-            while curr_block.priorHash in self.blocks:
-                curr_height += 1
-                curr_block = self.blocks[curr_block.priorHash]
-
-            if curr_height == height:
-                results.append(self.blocks[block_hash])
-        return results
+        return list(self.by_height.get(height, []))
 
     def extend(self, block):
         """Adds this block into the blockchain in the proper location, if it is valid.  The "proper location" may not be the tip!
@@ -399,32 +686,20 @@ class Blockchain(object):
 
            Return false if the block is invalid (breaks any miner constraints), and do not add it to the blockchain."""
         
-        # find the prior block
-        print("block", block)
-        print("block.contents", block.contents)
-        print("block.getHash()", block.getHash())
-        print("block.priorHash", block.priorHash)
-        print("block.contents.transactions", block.contents.transactions)
+        logger.debug("extend prior=%x txs=%d", block.priorHash, len(block.contents.transactions))
 
+        # find the prior block
         prior_block = self.blocks.get(block.priorHash, None)
         if prior_block is None:
-            print("Can't find prior block:", block.priorHash)
+            logger.debug("Can't find prior block: %x", block.priorHash)
             return False
 
-        # Retrieve or initialize UTXO state for prior block
-        unspent_outputs = self.utxo_state.get(prior_block.getHash(), None)
-        print("unspent_outputs", unspent_outputs)
-        if unspent_outputs is None or unspent_outputs == {}:
-            # genesis
-            unspent_outputs = prior_block.validate({}, self.maxMintCoinsPerTx)
-            print("genesis unspent_outputs", unspent_outputs)
-            if unspent_outputs is None:
-                return False
-            self.utxo_state[prior_block.getHash()] = unspent_outputs
-        print("check")
+        # Every block in the chain (genesis included) has its UTXO state stored when it is added
+        unspent_outputs = self.utxo_state.get(block.priorHash, None)
+        assert unspent_outputs is not None, "parent UTXO missing -- invariant broken"
         new_utxo_state = block.validate(unspent_outputs, self.maxMintCoinsPerTx)
-        print("new_utxo_state", new_utxo_state)
         if new_utxo_state is None:
+            logger.debug("invalid block on prior=%x", block.priorHash)
             return False
 
         # Append block to blockchain and store UTXO state
@@ -433,6 +708,15 @@ class Blockchain(object):
             self.cumulative_work[block.getPriorBlockHash()] + self.getWork(block.getTarget())
         )
         self.utxo_state[block.getHash()] = new_utxo_state
+        # Strictly greater, so the first block to reach the most work stays the tip
+        if self.cumulative_work[block.getHash()] > self.cumulative_work[self._tip_hash]:
+            self._tip_hash = block.getHash()
+
+        if block.getHash() not in self.height:  # a block extended twice is only listed once
+            h = self.height[block.getPriorBlockHash()] + 1
+            self.height[block.getHash()] = h
+            self.by_height.setdefault(h, []).append(block)
+            self.ancestor_bits[block.getHash()] = self.ancestor_bits[block.getPriorBlockHash()] | (1 << (block.getPriorBlockHash() & 63))
 
         return True
 
@@ -450,12 +734,21 @@ def Test():
     b2.mine(int("F"*63,16))
     h2 = b2.getHash()
     assert h2 < h1
+    # Float targets (as produced by dividing a target) must be usable and respected exactly
+    b3 = Block()
+    b3.mine(int("F"*64,16) / 3)
+    assert b3.getHash() < int("F"*64,16) / 3
 
     t0 = Transaction(None, [Output(lambda x: True, 100)])
     # Negative test: minted too many coins
     assert t0.validateMint(50) == False, "1 output: tx minted too many coins"
     # Positive test: minted the right number of coins
     assert t0.validateMint(100) == True, "1 output: tx minted the right number of coins"
+    # Non-integer amounts must hash (and must not collide with the equal integer amount)
+    assert Transaction(None, [Output(None, 2.5)]).getHash() != Transaction(None, [Output(None, 2)]).getHash()
+    # data of any type hashes, distinct types don't collide, and an int is not treated as a buffer length
+    hashes = [Transaction(None, [], d).getHash() for d in [None, b'', '', 3, b'\x00\x00\x00', '3', {"height": 1}, 1234567890]]
+    assert len(set(hashes)) == len(hashes)
 
     class GivesHash:
         def __init__(self, hash):
@@ -467,4 +760,116 @@ def Test():
     
     assert HashableMerkleTree([GivesHash(x) for x in [106874969902263813231722716312951672277654786095989753245644957127312510061509, 66221123338548294768926909213040317907064779196821799240800307624498097778386, 98188062817386391176748233602659695679763360599522475501622752979264247167302]]).calcMerkleRoot().to_bytes(32,"big").hex() == "ea670d796aa1f950025c4d9e7caf6b92a5c56ebeb37b95b072ca92bc99011c20"
 
+    # Constraint scripts only allow spending when they return exactly True; throwing or any other value refuses
+    def spendsWith(constraint, satisfier):
+        utxo = {(t0.getHash(), 0): Output(constraint, 10)}
+        return Transaction([Input(t0.getHash(), 0, satisfier)], [Output(None, 10)]).validate(utxo)
+    assert spendsWith(lambda x: x[0] + x[1] == 100, [40, 60]) == True, "constraint returning True allows spending"
+    assert spendsWith(lambda x: x[0] + x[1] == 100, ["a", 1]) == False, "constraint that throws refuses spending"
+    assert spendsWith(lambda x: 1, []) == False, "constraint returning 1 (not True) refuses spending"
+    # Many inputs: one throwing constraint among 40 refuses the whole transaction
+    many = Transaction(None, [Output(None, 1) for _ in range(40)])
+    utxo = {(many.getHash(), k): Output(lambda x, k=k: x == k, 1) for k in range(40)}
+    utxo[(many.getHash(), 39)] = Output(lambda x: x[0], 1)
+    satisfiers = list(range(40))
+    spend = lambda: Transaction([Input(many.getHash(), k, satisfiers[k]) for k in range(40)], [Output(None, 40)])
+    assert spend().validate(utxo) == False, "a throwing constraint among many inputs refuses spending"
+    satisfiers[39] = [True]
+    assert spend().validate(utxo) == True, "40 inputs with satisfied constraints can be spent"
+
+    def child(parent, tag, target=int("F"*64,16)):
+        """ mine a block (made unique by tag) on top of parent """
+        blk = Block()
+        blk.setPriorBlockHash(parent.getHash())
+        blk.setContents([Transaction(None, [Output(None, 1)], tag)])
+        blk.mine(target)
+        return blk
+
+    # getBlocksAtHeight: forks at the same height come back in insertion order, each block once
+    chain = Blockchain(int("F"*64,16), 100)
+    genesis = chain.getTip()
+    left, right = child(genesis, b"left"), child(genesis, b"right")
+    assert chain.extend(left) and chain.extend(right) and chain.extend(left)  # left is extended twice
+    assert chain.getBlocksAtHeight(0) == [genesis]
+    assert chain.getBlocksAtHeight(1) == [left, right]
+    assert chain.getBlocksAtHeight(2) == []
+
+    # getTip: of two branches with equal work, the first one added stays the tip
+    assert chain.getTip() is left
+    # A short fork with a lower target (more work) overtakes a longer chain
+    chain = Blockchain(int("F"*64,16), 100)
+    genesis = chain.getTip()
+    a1 = child(genesis, b"a1")
+    a2 = child(a1, b"a2")
+    a3 = child(a2, b"a3")
+    for blk in (a1, a2, a3):
+        assert chain.extend(blk)
+    assert chain.getTip() is a3  # cumulative work 4
+    fork = child(genesis, b"fork", int("F"*64,16) // 8)
+    assert chain.extend(fork)
+    assert chain.getTip() is fork  # cumulative work 1 + 8
+    assert chain.getCumulativeWork(fork.getHash()) > chain.getCumulativeWork(a3.getHash())
+
+    # isAncestor: a 70 block chain nearly fills the 64 bit filter, so non-ancestors have to be ruled out by the walk
+    chain = Blockchain(int("F"*64,16), 100)
+    line = [chain.getTip()]
+    for i in range(70):
+        blk = Block()
+        blk.setPriorBlockHash(line[-1].getHash())
+        blk.setContents([Transaction(None, [Output(None, 1)], bytes([i]))])
+        blk.mine(int("F"*64,16))
+        assert chain.extend(blk)
+        line.append(blk)
+    fork = Block()
+    fork.setPriorBlockHash(line[0].getHash())
+    fork.mine(int("F"*64,16))
+    assert chain.extend(fork)
+    tipHash = line[-1].getHash()
+    assert all(chain.isAncestor(blk.getHash(), tipHash) for blk in line[:-1]), "every earlier block is an ancestor of the tip"
+    assert not chain.isAncestor(tipHash, tipHash), "a block is not its own ancestor"
+    assert not chain.isAncestor(tipHash, line[1].getHash()), "descendants are not ancestors"
+    assert not chain.isAncestor(fork.getHash(), tipHash) and not chain.isAncestor(line[1].getHash(), fork.getHash()), "blocks on another fork are not ancestors"
+    assert chain.isAncestor(line[0].getHash(), fork.getHash())
+    assert not chain.isAncestor(12345, tipHash), "unknown blocks are not ancestors"
+
+    # A block's hash follows its contents, including a reused tree that was changed and set again
+    tx1, tx2 = Transaction(None, [Output(None, 1)]), Transaction(None, [Output(None, 2)])
+    tree = HashableMerkleTree([tx1])
+    blk = Block()
+    blk.setContents(tree)
+    tree.hashableList.append(tx2)
+    blk.getContents().setData(tree)
+    fresh = Block()
+    fresh.setContents([tx1, tx2])
+    assert blk.getHash() == fresh.getHash()
+
+    # UTXOView: layered sets must behave like independent dicts
+    base = {("a", 0): 1, ("b", 0): 2}
+    view = UTXOView(base)
+    base.clear()  # the caller's dict is copied, so this can't change the view
+    assert len(view) == 2 and dict(view) == {("a", 0): 1, ("b", 0): 2}
+    del view[("a", 0)]
+    view[("c", 0)] = 3
+    assert len(view) == 2 and ("a", 0) not in view and view[("c", 0)] == 3
+    view[("a", 0)] = 4  # delete then re-add
+    assert len(view) == 3 and view[("a", 0)] == 4
+    view[("b", 0)] = 5  # replacing a parent entry doesn't change the size
+    assert len(view) == 3 and dict(view) == {("a", 0): 4, ("b", 0): 5, ("c", 0): 3}
+    try:
+        del view[("z", 0)]
+        assert False, "deleting a missing key must raise KeyError"
+    except KeyError:
+        pass
+    # Two forks off the same parent don't see each other's changes
+    left, right = UTXOView(view), UTXOView(view)
+    del left[("c", 0)]
+    right[("d", 0)] = 6
+    assert ("c", 0) in right and ("d", 0) not in left and len(left) == 2 and len(right) == 4 and len(view) == 3
+    # A deep chain of views is flattened periodically and still sees the oldest entries
+    deep = view
+    for i in range(3 * UTXOView.MAX_DEPTH):
+        deep = UTXOView(deep)
+        deep[("deep", i)] = i
+    assert deep.depth <= UTXOView.MAX_DEPTH and deep[("c", 0)] == 3 and len(deep) == 3 + 3 * UTXOView.MAX_DEPTH
+
     print ("yay local tests passed")